@@ -11,6 +11,9 @@ except ImportError:
 if has_setuptools:
     extra_kwargs = {
         "requires": ["Pyramid", "Sphinx"],
+        "entry_points": {
+            "console_scripts": ["wegweiser-extract = wegweiser.extract:main"]
+        },
         "zip_safe": False
     }
 else:
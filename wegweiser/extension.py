@@ -7,10 +7,12 @@
 """
 
 import collections
-import json
+import hashlib
 import os
+import pickle
 import subprocess
 import sys
+import tempfile
 from functools import partial
 
 from docutils import nodes, statemachine
@@ -20,38 +22,110 @@ from sphinx.util.docstrings import prepare_docstring
 from sphinx.util.nodes import nested_parse_with_titles
 
 
+# Mapping app config => {"registry": app's registry}, or ``None`` if the
+# app can't be imported in-process. Cleared for every build, see
+# `reset_build_caches`
+_bootstrapped_apps = {}
+
+# App configs whose app was imported in-process by an earlier build. The
+# app's modules can't be reloaded reliably, so later builds in the same
+# process use the helper script to see changes to the views
+_previously_bootstrapped_apps = set()
+
+# Mapping helper script arguments => (SHA-256 of output, parsed output)
+_parsed_outputs = {}
+
+
 def get_routes(config, prefix=None, group_by=None):
+    """Extracts the routes out of the pyramid app. If the app can be
+    imported, this is done in-process, otherwise the helper script is
+    executed in a subprocess."""
+    config = os.path.expanduser(config)
+    if config in _previously_bootstrapped_apps:
+        return _run_extract_script(config, prefix, group_by)
+    try:
+        from wegweiser import extract
+    except ImportError:
+        return _run_extract_script(config, prefix, group_by)
+    if config not in _bootstrapped_apps:
+        try:
+            env = extract.paster.bootstrap(config)
+        except ImportError:
+            _bootstrapped_apps[config] = None
+        else:
+            # Only the registry is needed, so pop the threadlocals again
+            env["closer"]()
+            _bootstrapped_apps[config] = {"registry": env["registry"]}
+    env = _bootstrapped_apps[config]
+    if env is None:
+        return _run_extract_script(config, prefix, group_by)
+    return extract.collect(env, prefix, group_by)
+
+
+def _run_extract_script(config, prefix=None, group_by=None):
     """Executes the helper script that extracts the routes out of the
     pyramid app."""
     python = sys.executable
     script = os.path.join(os.path.dirname(__file__), "extract.py")
-    config = os.path.expanduser(config)
-    args = [python, script, config]
+    args = [python, script, config, "--format=pickle"]
     if group_by:
         args.append("--group=" + group_by)
     if prefix:
         args.append("--prefix=" + prefix)
-    p = subprocess.Popen(args=args, stdout=subprocess.PIPE)
-    (stdout, _) = p.communicate()
-    return json.loads(stdout.decode("utf-8"))
+    with tempfile.TemporaryFile() as f:
+        subprocess.Popen(args=args, stdout=f).wait()
+        f.seek(0)
+        stdout = f.read()
+    digest = hashlib.sha256(stdout).hexdigest()
+    cached = _parsed_outputs.get(tuple(args))
+    if cached is not None and cached[0] == digest:
+        return cached[1]
+    routes = pickle.loads(stdout)
+    _parsed_outputs[tuple(args)] = (digest, routes)
+    return routes
+
+
+def hash_file(filename):
+    """Returns the SHA-256 hex digest of the given file's content."""
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
 
 
 class _PyramidDirective(Directive):
+    _prefix = None
+    _strip_start = 0
+
     def _prepare_env(self):
         env = self.state.document.settings.env
         if not hasattr(env, "pyramid_routes"):
-            # Mapping docname => list of view source files
-            env.pyramid_routes = collections.defaultdict(set)
+            # Mapping docname => {view source file: (mtime, hash)}
+            env.pyramid_routes = collections.defaultdict(dict)
 
     def _get_routes(self, prefix=None, group_by=None):
         config = self.state.document.settings.env.app.config
         return get_routes(
             config.wegweiser["app_config"], prefix=prefix, group_by=group_by)
 
+    def _record_source_file(self, filename):
+        """Records that the current document depends on the given source
+        file, together with the file's current mtime and content hash.
+        Files that aren't on the file system (e.g. inside zipped eggs)
+        aren't tracked."""
+        env = self.state.document.settings.env
+        source_files = env.pyramid_routes[env.docname]
+        # The document's records are purged before it is read again, so
+        # an existing record is up to date
+        if filename not in source_files:
+            try:
+                source_files[filename] = (
+                    os.path.getmtime(filename), hash_file(filename))
+            except OSError:
+                pass
+
     def _render_route(self, route):
         env = self.state.document.settings.env
         if route["doc"]:
-            env.pyramid_routes[env.docname].add(route["doc"][0])
+            self._record_source_file(route["doc"][0])
         serialno = env.new_serialno(route["name"])
         route_id = "route-{0}-{1}".format(route["name"], serialno)
         route_node = nodes.section(ids=[route_id])
@@ -107,13 +181,20 @@ class _PyramidDirective(Directive):
         nested_parse_with_titles(self.state, content, node)
         self.state.memo.reporter = old_reporter
 
+    def _set_prefix(self, prefix):
+        """Sets the prefix that is stripped from the rendered route
+        patterns. A trailing slash of the prefix is kept in the pattern.
+        """
+        self._prefix = prefix
+        if prefix:
+            self._strip_start = len(prefix) - prefix.endswith("/")
+
     def _strip_prefix(self, pattern):
-        """Strips the prefix set in the directive's options from the given
-        route pattern.
+        """Strips the prefix set with `_set_prefix` from the given route
+        pattern.
         """
-        prefix = self.options.get("prefix")
-        if prefix and pattern.startswith(prefix):
-            pattern = pattern[len(prefix) - prefix.endswith("/"):]
+        if self._prefix and pattern.startswith(self._prefix):
+            pattern = pattern[self._strip_start:]
         return pattern
 
 
@@ -125,22 +206,15 @@ class PyramidRouteDirective(_PyramidDirective):
 
     def run(self):
         self._prepare_env()
-        routes = dict((r["name"], r) for r in self._get_routes())
-        return [self._render_route(routes[self.arguments[0]])]
-
-
-class _GroupRendererRegistry(object):
-    def __init__(self):
-        self.renderers = {}
-
-    def __call__(self, name):
-        def decorator(f):
-            self.renderers[name] = f
-            return f
-        return decorator
+        env = self.state.document.settings.env
+        if not hasattr(env, "wegweiser_routes_by_name"):
+            # Shared by all directives while reading, see
+            # `drop_routes_by_name`
+            env.wegweiser_routes_by_name = dict(
+                (r["name"], r) for r in self._get_routes())
+        return [self._render_route(
+            env.wegweiser_routes_by_name[self.arguments[0]])]
 
-    def __getitem__(self, item):
-        return self.renderers[item]
 
 class PyramidRoutesDirective(_PyramidDirective):
     """Document all Pyramid routes.
@@ -151,8 +225,6 @@ class PyramidRoutesDirective(_PyramidDirective):
           :prefix: /example
     """
 
-    group_renderer = _GroupRendererRegistry()
-
     option_spec = {
         "prefix": directives.unchanged,
         "groupby": partial(directives.choice, values=["module"])
@@ -162,22 +234,20 @@ class PyramidRoutesDirective(_PyramidDirective):
         self._prepare_env()
         group_by = self.options.get("groupby", "")
         prefix = self.options.get("prefix")
+        self._set_prefix(prefix)
         routes = self._get_routes(prefix=prefix, group_by=group_by)
         try:
-            renderer = self.group_renderer[group_by]
+            renderer = self._GROUP_RENDERERS[group_by]
         except KeyError:
             raise self.error("Invalid group: {0!r}".format(group_by))
         else:
             return renderer(self, routes)
 
-    @group_renderer("")
     def _default_group_renderer(self, routes):
         return [self._render_route(route) for route in routes]
 
-    @group_renderer("module")
     def _module_group_renderer(self, modules):
         result = []
-        env = self.state.document.settings.env
         for (name, module) in modules.items():
             node_id = "module-" + name
             node = nodes.section(ids=[node_id])
@@ -185,31 +255,94 @@ class PyramidRoutesDirective(_PyramidDirective):
             node += nodes.title(text=name)
             if module["doc"]:
                 self._render_docstring(node, *module["doc"])
-                env.pyramid_routes[env.docname].add(module["doc"][0])
+                self._record_source_file(module["doc"][0])
             for route in module["routes"]:
                 node += self._render_route(route)
         return result
 
+    _GROUP_RENDERERS = {
+        "": _default_group_renderer,
+        "module": _module_group_renderer
+    }
+
 
 def get_outdated_documents(app, env, added, changed, removed):
     changed = []
     if hasattr(env, "pyramid_routes"):
+        # Source files are usually shared by many documents, so every
+        # file is only stat'ed (and hashed, if needed) once
+        mtimes = {}
+        digests = {}
         for (document, source_files) in env.pyramid_routes.items():
-            for filename in source_files:
-                mtime = os.path.getmtime(filename)
-                if mtime > env.all_docs[document]:
+            # Environments pickled by older versions store sets of files
+            if not isinstance(source_files, dict):
+                changed.append(document)
+                continue
+            for (filename, (mtime, digest)) in source_files.items():
+                if filename not in mtimes:
+                    try:
+                        mtimes[filename] = os.path.getmtime(filename)
+                    except OSError:
+                        mtimes[filename] = None
+                # Only hash the file's content if its mtime changed, as
+                # checkouts (e.g. on CI) touch files without changing them
+                if mtimes[filename] == mtime:
+                    continue
+                if mtimes[filename] is None:
+                    changed.append(document)
+                    break
+                if filename not in digests:
+                    digests[filename] = hash_file(filename)
+                if digests[filename] != digest:
                     changed.append(document)
                     break
+                # Unchanged content, so don't hash the file again next time
+                source_files[filename] = (mtimes[filename], digest)
     return changed
 
+def reset_build_caches(app, env, docnames):
+    """Drops everything extracted by a previous build in this process."""
+    drop_routes_by_name(app, env)
+    for (config, bootstrapped) in _bootstrapped_apps.items():
+        if bootstrapped is not None:
+            _previously_bootstrapped_apps.add(config)
+    _bootstrapped_apps.clear()
+    extract = sys.modules.get("wegweiser.extract")
+    if extract is not None:
+        extract._get_docstring_lines.cache_clear()
+
+def drop_routes_by_name(app, env):
+    """Drops the route table once all documents are read, so it isn't
+    pickled with the environment."""
+    if hasattr(env, "wegweiser_routes_by_name"):
+        del env.wegweiser_routes_by_name
+
 def purge_pyramid_routes(app, env, docname):
     if hasattr(env, "pyramid_routes"):
-        if docname in env.pyramid_routes:
-            del env.pyramid_routes[docname]
+        env.pyramid_routes.pop(docname, None)
+
+def merge_pyramid_routes(app, env, docnames, other):
+    """Merges the data collected by a parallel reader process back into
+    the main environment."""
+    if hasattr(other, "pyramid_routes"):
+        if not hasattr(env, "pyramid_routes"):
+            env.pyramid_routes = collections.defaultdict(dict)
+        for docname in docnames:
+            if docname in other.pyramid_routes:
+                env.pyramid_routes[docname] = other.pyramid_routes[docname]
 
 def setup(app):
     app.add_directive("pyramidroute", PyramidRouteDirective)
     app.add_directive("pyramidroutes", PyramidRoutesDirective)
     app.add_config_value("wegweiser", {}, "env")
     app.connect("env-get-outdated", get_outdated_documents)
+    app.connect("env-before-read-docs", reset_build_caches)
     app.connect("env-purge-doc", purge_pyramid_routes)
+    app.connect("env-merge-info", merge_pyramid_routes)
+    app.connect("env-updated", drop_routes_by_name)
+    return {
+        "version": "0.1",
+        "env_version": 1,
+        "parallel_read_safe": True,
+        "parallel_write_safe": True
+    }
@@ -3,7 +3,9 @@
 """
     Helper for Wegweiser: Tries to find the views for all routes and
     prints out a JSON serialized object with the route patterns as
-    keys and the corresponding view as value.
+    keys and the corresponding view as value. With ``--format=pickle``,
+    the object is written as pickle instead (this is what the Sphinx
+    extension uses, as it is considerably faster to load).
 
     Example output (no grouping)::
 
@@ -26,19 +28,44 @@
 """
 
 import argparse
+import ast
+import functools
 import inspect
 import json
+import linecache
 import operator
+import pickle
 import sys
 
 from pyramid import interfaces, paster, traversal
 from pyramid.request import Request
 from zope.interface import providedBy
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def find_view(registry, route):
+
+def _find_context(registry, root_factory):
+    """Returns a pair (interfaces provided by the context, view name) for
+    an empty request traversed from the root returned by `root_factory`.
+    """
+    request_factory = registry.queryUtility(
+        interfaces.IRequestFactory, default=Request)
+    request = request_factory({})
+    root = root_factory(request)
+
+    traverser = registry.adapters.queryAdapter(root, interfaces.ITraverser)
+    if traverser is None:
+        traverser = traversal.ResourceTreeTraverser(root)
+    tdict = traverser(request)
+    return (providedBy(tdict["context"]), tdict["view_name"])
+
+def find_view(registry, route, contexts=None):
     """Given a registry and a route, try to find the corresponding view
-    callable.
+    callable. If given, `contexts` is a dictionary that caches the context
+    found for each root factory, so it can be shared between calls.
 
     Limitations:
 
@@ -50,21 +77,14 @@ def find_view(registry, route):
         interfaces.IRouteRequest, name=route.name, default=interfaces.IRequest)
     root_factory = route.factory or root_factory
 
-    request_factory = registry.queryUtility(
-        interfaces.IRequestFactory, default=Request)
-    request = request_factory({})
-    root = root_factory(request)
-
     # Find context
-    traverser = registry.adapters.queryAdapter(root, interfaces.ITraverser)
-    if traverser is None:
-        traverser = traversal.ResourceTreeTraverser(root)
-    tdict = traverser(request)
-    context = tdict["context"]
-    view_name = tdict["view_name"]
+    if contexts is None:
+        contexts = {}
+    if root_factory not in contexts:
+        contexts[root_factory] = _find_context(registry, root_factory)
+    (context_iface, view_name) = contexts[root_factory]
 
     # Find view callable
-    context_iface = providedBy(context)
     view = registry.adapters.lookup(
         (interfaces.IViewClassifier, request_iface, context_iface),
         interfaces.IView, name=view_name, default=None)
@@ -105,6 +125,50 @@ def _get_unwrapped(func):
             break
     return func
 
+def _collect_docstring_lines(node, prefix, result):
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, (ast.ClassDef, ast.FunctionDef,
+                              ast.AsyncFunctionDef)):
+            qualname = prefix + child.name
+            # Decorators are part of the definition, like in `co_firstlineno`
+            first_line = min(
+                [child.lineno] + [d.lineno for d in child.decorator_list])
+            if ast.get_docstring(child, clean=False) is not None:
+                doc_line = child.body[0].lineno
+            else:
+                doc_line = None
+            result.setdefault(qualname, []).append((first_line, doc_line))
+            if isinstance(child, ast.ClassDef):
+                child_prefix = qualname + "."
+            else:
+                child_prefix = qualname + ".<locals>."
+            _collect_docstring_lines(child, child_prefix, result)
+        else:
+            _collect_docstring_lines(child, prefix, result)
+
+@functools.lru_cache(maxsize=None)
+def _get_docstring_lines(filename, module):
+    """Parses the given source file of the given module and returns a
+    dictionary mapping qualified names of classes and functions to a list
+    of (first line of definition, line where the docstring begins or
+    ``None``) pairs, one for each definition in the file. The module's
+    docstring is stored under the empty name.
+    """
+    # Like `inspect.findsource`: The module's globals let `linecache` get
+    # the source from the module's loader (e.g. for zipped eggs)
+    linecache.checkcache(filename)
+    module_globals = getattr(module, "__dict__", None)
+    source = "".join(linecache.getlines(filename, module_globals))
+    try:
+        tree = ast.parse(source, filename)
+    except (SyntaxError, ValueError):
+        return {}
+    result = {}
+    if ast.get_docstring(tree, clean=False) is not None:
+        result[""] = [(1, tree.body[0].lineno)]
+    _collect_docstring_lines(tree, "", result)
+    return result
+
 def get_docstring(func):
     """Returns a triplet (filename, lineno of docstring start, docstring)
     for the given object. If the object is a function and the function
@@ -115,22 +179,31 @@ def get_docstring(func):
         filename = inspect.getsourcefile(func)
     except TypeError:
         return None
-    (lines, start_offset) = inspect.getsourcelines(func)
-    # Unfortunately, `inspect-getsourcelines` always returns 0 as start_offset
-    start_offset = max(start_offset, 1)
-    for (lineno, line) in enumerate(lines, start_offset):
-        if line.lstrip().startswith(('"', "'")):
-            break
+    if filename is None:
+        return None
+    if inspect.ismodule(func):
+        (module, qualname) = (func, "")
     else:
+        module = inspect.getmodule(func, filename)
+        qualname = getattr(func, "__qualname__", None)
+    definitions = _get_docstring_lines(filename, module).get(qualname, [])
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        # The name may be defined more than once (e.g. in if/else
+        # branches), so match the function's definition by its line
+        definitions = [
+            d for d in definitions if d[0] == code.co_firstlineno]
+    if not definitions or definitions[0][1] is None:
         return None
     docstring = inspect.getdoc(func)
     if docstring is not None:
-        return (filename, lineno, docstring)
+        return (filename, definitions[0][1], docstring)
     return None
 
-def collect(env):
-    """Returns a list of routes, sorted by pattern. Each route is a dictionary
-    with the following keys:
+def collect(env, prefix=None, group_by=None):
+    """Returns a list of routes of the app in the given environment (as
+    returned by ``pyramid.paster.bootstrap``), sorted by pattern. Each
+    route is a dictionary with the following keys:
 
        * ``name``: The route's name
        * ``pattern``: The route's pattern
@@ -141,53 +214,60 @@ def collect(env):
          returned by ``inspect.getdoc``) or ``None`` if no docstring could
          be found.
        * ``renderer``: The renderer that is used by the route's view.
+
+    If `prefix` is given, only routes whose pattern starts with `prefix`
+    are included. If `group_by` is ``"module"``, a dictionary mapping
+    module names to dictionaries with the keys ``doc`` (the module's
+    docstring) and ``routes`` (the module's routes, sorted by pattern) is
+    returned instead, ordered by the modules' first pattern.
     """
     routes = []
+    grouped = {}
+    # Mapping id(unwrapped view) => docstring, as views are often shared
+    # between routes
+    docstrings = {}
+    # Mapping root factory => context, see `find_view`
+    contexts = {}
     mapper = env["registry"].queryUtility(interfaces.IRoutesMapper)
-    root_factory = env["registry"].queryUtility(
-        interfaces.IRootFactory, default=traversal.DefaultRootFactory)
-    request_factory = env["registry"].queryUtility(
-        interfaces.IRequestFactory, default=Request)
-    request = request_factory({})
-    root = root_factory(request)
-    traverser = env["registry"].adapters.queryAdapter(root, interfaces.ITraverser)
-    if traverser is None:
-        traverser = traversal.ResourceTreeTraverser(root)
 
     for (name, route) in mapper.routes.items():
-        view = find_view(env["registry"], route)
-        renderer = get_view_renderer(view)
-        predicates = get_view_predicates(view)
         pattern = route.pattern
         if not pattern.startswith("/"):
             pattern = "/" + pattern
+        if prefix and not pattern.startswith(prefix):
+            continue
+        view = find_view(env["registry"], route, contexts)
+        renderer = get_view_renderer(view)
+        predicates = get_view_predicates(view)
+        module = inspect.getmodule(view)
+        unwrapped = _get_unwrapped(view)
+        if id(unwrapped) not in docstrings:
+            docstrings[id(unwrapped)] = get_docstring(unwrapped)
         value = {
             "name": route.name,
             "pattern": pattern,
             "predicates": predicates,
-            "module": inspect.getmodule(view).__name__,
-            "doc": get_docstring(view),
+            "module": module.__name__,
+            "doc": docstrings[id(unwrapped)],
             "renderer": None
         }
         if renderer is not None:
             value["renderer"] = renderer.name
-        routes.append(value)
-    return sorted(routes, key=operator.itemgetter("pattern"))
-
-def group_by_modules(routes):
-    grouped = {}
-    for route in routes:
-        name = route["module"]
-        if name not in grouped:
-            module = sys.modules[name]
-            grouped[name] = {"doc": get_docstring(module), "routes": []}
-        grouped[name]["routes"].append(route)
-    return grouped
-
+        if group_by == "module":
+            if module.__name__ not in grouped:
+                grouped[module.__name__] = {
+                    "doc": get_docstring(module), "routes": []}
+            grouped[module.__name__]["routes"].append(value)
+        else:
+            routes.append(value)
 
-GROUP_FUNCS = {
-    "module": group_by_modules
-}
+    if group_by == "module":
+        for group in grouped.values():
+            group["routes"].sort(key=operator.itemgetter("pattern"))
+        return dict(sorted(
+            grouped.items(), key=lambda item: item[1]["routes"][0]["pattern"]))
+    routes.sort(key=operator.itemgetter("pattern"))
+    return routes
 
 def main(args=None):
     if args is None:
@@ -196,21 +276,19 @@ def main(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("config")
     parser.add_argument("--prefix")
-    parser.add_argument("--group", choices=GROUP_FUNCS.keys())
+    parser.add_argument("--group", choices=["module"])
+    parser.add_argument("--format", choices=["json", "pickle"], default="json")
     options = parser.parse_args(args)
 
-    if options.group:
-        group_func = GROUP_FUNCS[options.group]
-    else:
-        group_func = None
-
     env = paster.bootstrap(options.config)
-    routes = collect(env)
-    if options.prefix:
-        routes = [r for r in routes if r["pattern"].startswith(options.prefix)]
-    if group_func is not None:
-        routes = group_func(routes)
-    json.dump(routes, sys.stdout)
+    routes = collect(env, options.prefix, options.group)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    if options.format == "pickle":
+        pickle.dump(routes, stdout, pickle.HIGHEST_PROTOCOL)
+    elif orjson is not None:
+        stdout.write(orjson.dumps(routes))
+    else:
+        json.dump(routes, sys.stdout)
     return 0
 
 if __name__ == "__main__":